@@ -6,231 +6,84 @@ Supports image uploads and clipboard paste for visual analysis.
 """
 
 import os
-import base64
+import io
+import json
+import binascii
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 import streamlit as st
 import chromadb
+import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 import anthropic
+import httpx
 import streamlit.components.v1 as components
 from dotenv import load_dotenv
 import fitz  # PyMuPDF
+from PIL import Image, ImageOps
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Configuration
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 CHROMA_PATH = os.path.expanduser("~/Desktop/StudyAssistant/chroma_db")
+CHROMA_HOST = os.environ.get("CHROMA_HOST")  # set to query a `chroma run` server instead of opening CHROMA_PATH
+CHROMA_PORT = int(os.environ.get("CHROMA_PORT", "8000"))
+PROCESSED_LOG = os.path.expanduser("~/Desktop/StudyAssistant/.processed_files.json")  # written by ingest.py
 COLLECTION_NAME = "study_materials"
+EMBEDDING_MODEL = "all-mpnet-base-v2"
+
+# CPU embedding backend: "torch", or "onnx" / "openvino" to run the hub's INT8-quantized export
+# (needs `pip install "sentence-transformers[onnx]"` or `"sentence-transformers[openvino]"`)
+EMBEDDING_BACKEND = "torch"
+QUANTIZED_MODEL_FILES = {
+    "onnx": "onnx/model_qint8_avx512_vnni.onnx",
+    "openvino": "openvino/openvino_model_qint8_quantized.xml",
+}
 TOP_K = 10
 
+# Collections up to this many chunks are searched exactly in memory instead of through Chroma
+IN_MEMORY_INDEX_MAX_CHUNKS = 100_000
 
-# JavaScript for clipboard paste functionality
-PASTE_IMAGE_JS = """
-<style>
-    #paste-zone {
-        border: 2px dashed #ccc;
-        border-radius: 10px;
-        padding: 20px;
-        text-align: center;
-        background: #f9f9f9;
-        margin: 10px 0;
-        cursor: pointer;
-        transition: all 0.3s ease;
-    }
-    #paste-zone:hover, #paste-zone.drag-over {
-        border-color: #4CAF50;
-        background: #e8f5e9;
-    }
-    #paste-zone.has-image {
-        border-color: #2196F3;
-        background: #e3f2fd;
-    }
-    #pasted-image {
-        max-width: 100%;
-        max-height: 300px;
-        margin-top: 10px;
-        border-radius: 5px;
-    }
-    .paste-instructions {
-        color: #666;
-        font-size: 14px;
-    }
-    .paste-success {
-        color: #4CAF50;
-        font-weight: bold;
-    }
-</style>
-
-<div id="paste-zone" tabindex="0">
-    <p class="paste-instructions">📋 Click here and press <strong>Cmd+V</strong> to paste a screenshot</p>
-    <p class="paste-instructions" style="font-size: 12px; color: #999;">Or drag & drop an image</p>
-    <img id="pasted-image" style="display: none;" />
-</div>
-
-<script>
-    const pasteZone = document.getElementById('paste-zone');
-    const pastedImage = document.getElementById('pasted-image');
-
-    // Handle paste event
-    pasteZone.addEventListener('paste', function(e) {
-        e.preventDefault();
-        const items = e.clipboardData.items;
-
-        for (let i = 0; i < items.length; i++) {
-            if (items[i].type.indexOf('image') !== -1) {
-                const blob = items[i].getAsFile();
-                const reader = new FileReader();
-
-                reader.onload = function(event) {
-                    const base64Data = event.target.result;
-                    pastedImage.src = base64Data;
-                    pastedImage.style.display = 'block';
-                    pasteZone.classList.add('has-image');
-                    pasteZone.querySelector('.paste-instructions').innerHTML = '<span class="paste-success">✓ Image pasted!</span> Paste again to replace.';
-
-                    // Send to Streamlit
-                    window.parent.postMessage({
-                        type: 'streamlit:setComponentValue',
-                        value: base64Data
-                    }, '*');
-                };
-
-                reader.readAsDataURL(blob);
-                break;
-            }
-        }
-    });
-
-    // Handle drag and drop
-    pasteZone.addEventListener('dragover', function(e) {
-        e.preventDefault();
-        pasteZone.classList.add('drag-over');
-    });
-
-    pasteZone.addEventListener('dragleave', function(e) {
-        e.preventDefault();
-        pasteZone.classList.remove('drag-over');
-    });
-
-    pasteZone.addEventListener('drop', function(e) {
-        e.preventDefault();
-        pasteZone.classList.remove('drag-over');
-
-        const files = e.dataTransfer.files;
-        if (files.length > 0 && files[0].type.indexOf('image') !== -1) {
-            const reader = new FileReader();
-
-            reader.onload = function(event) {
-                const base64Data = event.target.result;
-                pastedImage.src = base64Data;
-                pastedImage.style.display = 'block';
-                pasteZone.classList.add('has-image');
-                pasteZone.querySelector('.paste-instructions').innerHTML = '<span class="paste-success">✓ Image added!</span> Drop again to replace.';
-
-                // Send to Streamlit
-                window.parent.postMessage({
-                    type: 'streamlit:setComponentValue',
-                    value: base64Data
-                }, '*');
-            };
-
-            reader.readAsDataURL(files[0]);
-        }
-    });
-
-    // Focus on click
-    pasteZone.addEventListener('click', function() {
-        pasteZone.focus();
-    });
-
-    // Also listen for paste on the whole document (backup)
-    document.addEventListener('paste', function(e) {
-        if (document.activeElement === pasteZone) return; // Already handled
-
-        const items = e.clipboardData.items;
-        for (let i = 0; i < items.length; i++) {
-            if (items[i].type.indexOf('image') !== -1) {
-                pasteZone.dispatchEvent(new ClipboardEvent('paste', {
-                    clipboardData: e.clipboardData,
-                    bubbles: true
-                }));
-                break;
-            }
-        }
-    });
-</script>
-"""
-
-
-@st.cache_resource
-def load_models():
-    """Load embedding model (cached)."""
-    embedder = SentenceTransformer('all-mpnet-base-v2')
-    return embedder
-
-
-@st.cache_resource
-def load_database():
-    """Load ChromaDB (cached)."""
-    if not os.path.exists(CHROMA_PATH):
-        return None, None
-
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-    try:
-        collection = client.get_collection(name=COLLECTION_NAME)
-        return client, collection
-    except:
-        return client, None
+# Text-only questions whose closest source is farther than this (cosine distance) skip Claude
+RELEVANCE_CUTOFF = 0.6
 
+EXAMPLE_QUESTIONS = (
+    "What visualization is best for hierarchical data?",
+    "Explain the principles of visual encoding",
+)
 
-def extract_pdf_text(uploaded_file) -> str:
-    """Extract text from an uploaded PDF file."""
-    pdf_bytes = uploaded_file.getvalue()
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    pages = []
-    for i, page in enumerate(doc, 1):
-        text = page.get_text().strip()
-        if text:
-            pages.append(f"[Page {i}]\n{text}")
-    doc.close()
-    return "\n\n".join(pages)
+# Answer length cap (same as query.py; long answers still need room for their References section)
+MAX_TOKENS = 2048
 
+# Answer cache (identical question + sources + attachments skip the Claude call)
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_TTL = 3600  # seconds
 
-def get_relevant_chunks(query: str, embedder, collection, top_k: int = TOP_K) -> list:
-    """Retrieve relevant chunks from ChromaDB."""
-    query_embedding = embedder.encode(query).tolist()
+# Uploaded PDFs longer than this are cut to their first and last characters in the prompt
+MAX_PDF_CHARS = 60_000
+PDF_HEAD_CHARS = 40_000
+PDF_TAIL_CHARS = 20_000
 
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"]
-    )
+# Uploaded images are downscaled to Claude's effective vision resolution
+MAX_IMAGE_SIDE = 1568  # pixels
+MAX_IMAGE_BYTES = 4_500_000  # Claude API limit is 5MB, use 4.5MB for safety
+JPEG_QUALITY = 85
 
-    chunks = []
-    for i in range(len(results['ids'][0])):
-        chunks.append({
-            "text": results['documents'][0][i],
-            "filename": results['metadatas'][0][i]['filename'],
-            "pages": results['metadatas'][0][i]['pages'],
-            "distance": results['distances'][0][i]
-        })
-
-    return chunks
+# Query embedding batching (coalesces concurrent sessions into one encode call)
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_WAIT = 0.005  # seconds to wait for more queries before encoding
+EMBED_TOKEN_BUCKETS = (16, 32, 64, 128, 256)  # queries in the same bucket are padded together
 
 
-def query_claude(question: str, chunks: list, image_data: bytes = None, image_type: str = None, pdf_text: str = None) -> str:
-    """Send question and context to Claude, get answer with citations. Optionally include an image and/or PDF text."""
-
-    context_parts = []
-    for i, chunk in enumerate(chunks, 1):
-        context_parts.append(
-            f"[Source {i}: {chunk['filename']}, Page(s): {chunk['pages']}]\n{chunk['text']}"
-        )
-
-    context = "\n\n---\n\n".join(context_parts)
-
-    # IEEE/Vancouver citation style
-    system_prompt = """You are a study assistant for a Visual Analytics course.
+# IEEE/Vancouver citation style
+SYSTEM_PROMPT = """You are a study assistant for a Visual Analytics course.
 
 WHEN THE USER UPLOADS AN IMAGE:
 1. FIRST, directly analyze the uploaded image - describe what you see (chart type, axes, marks, colors, shapes, legends, etc.)
@@ -264,19 +117,10 @@ FORMAT YOUR RESPONSE:
   [1] Filename, Page(s): X
   [2] Filename, Page(s): Y"""
 
-    # Build the uploaded document section if PDF was provided
-    pdf_section = ""
-    if pdf_text:
-        pdf_section = f"""
-
-UPLOADED DOCUMENT CONTENT:
-{pdf_text}
-"""
-
-    user_text = f"""I have a question about Visual Analytics. I may have attached an image and/or a PDF document for you to analyze.
+USER_TEXT_TEMPLATE = """I have a question about Visual Analytics. I may have attached an image and/or a PDF document for you to analyze.
 
 MY QUESTION: {question}
-{pdf_section}
+
 RELEVANT COURSE MATERIAL EXCERPTS (use these for theoretical context and citations):
 {context}
 
@@ -286,43 +130,519 @@ INSTRUCTIONS:
 - Use the course material excerpts above to explain concepts and provide citations
 - The excerpts labeled [IMAGE/FIGURE...] are from my course slides, not my uploaded image"""
 
-    client = anthropic.Anthropic()
+PDF_SECTION_TEMPLATE = """UPLOADED DOCUMENT CONTENT:
+{pdf_text}"""
 
-    # Build message content
-    if image_data and image_type:
-        # Include image in the message
-        if isinstance(image_data, bytes):
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+
+def pick_device() -> str:
+    """Pick the fastest available device for the embedding model."""
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+@st.cache_resource
+def load_models():
+    """Load embedding model (cached), using reduced precision where the hardware supports it."""
+    device = pick_device()
+
+    if device == "cpu" and EMBEDDING_BACKEND in QUANTIZED_MODEL_FILES:
+        try:
+            return SentenceTransformer(
+                EMBEDDING_MODEL,
+                device=device,
+                backend=EMBEDDING_BACKEND,
+                model_kwargs={"file_name": QUANTIZED_MODEL_FILES[EMBEDDING_BACKEND]}
+            )
+        except Exception as e:
+            print(f"Warning: Could not load {EMBEDDING_BACKEND} embedding backend, using PyTorch: {e}")
+
+    if device == "cpu":
+        embedder = SentenceTransformer(EMBEDDING_MODEL, device=device)
+        transformer = embedder[0]
+
+        # BF16 via Intel Extension for PyTorch (Xeon with AVX-512/AMX); plain FP32 otherwise
+        try:
+            import intel_extension_for_pytorch as ipex
+            original = transformer.auto_model
+            try:
+                transformer.auto_model = ipex.optimize(original.eval(), dtype=torch.bfloat16)
+                embedder.encode("warm up")
+            except Exception:
+                transformer.auto_model = original
+        except ImportError:
+            pass
+        return embedder
+
+    # Load FP16 weights directly on CUDA/MPS (no FP32 copy), falling back to FP32 if the device can't run it
+    try:
+        embedder = SentenceTransformer(EMBEDDING_MODEL, device=device, model_kwargs={"torch_dtype": torch.float16})
+        embedder.encode("warm up")
+    except Exception:
+        embedder = SentenceTransformer(EMBEDDING_MODEL, device=device)
+    transformer = embedder[0]
+
+    # Compile on CUDA so repeated query shapes reuse CUDA graphs
+    if device == "cuda" and hasattr(torch, "compile"):
+        original = transformer.auto_model
+        try:
+            transformer.auto_model = torch.compile(original, mode="reduce-overhead")
+            embedder.encode("warm up")
+        except Exception:
+            transformer.auto_model = original
+
+    return embedder
+
+
+@st.cache_resource
+def load_database():
+    """Load ChromaDB (cached). Uses the Chroma server at CHROMA_HOST if set, else the local files."""
+    if not CHROMA_HOST and not os.path.exists(CHROMA_PATH):
+        return None, None
+
+    client = None
+    try:
+        # HttpClient connects on creation, so an unreachable server lands in the except below too
+        if CHROMA_HOST:
+            client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
         else:
-            image_base64 = image_data  # Already base64
-
-        message_content = [
-            {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": image_type,
-                    "data": image_base64
-                }
-            },
-            {
-                "type": "text",
-                "text": user_text
-            }
+            client = chromadb.PersistentClient(path=CHROMA_PATH)
+        collection = client.get_collection(name=COLLECTION_NAME)
+        return client, collection
+    except:
+        return client, None
+
+
+@st.cache_resource
+def get_anthropic_client():
+    """Create the Anthropic client (cached, so its connection pool is reused across questions)."""
+    return anthropic.Anthropic(
+        max_retries=2,
+        timeout=60.0,
+        http_client=httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=8))
+    )
+
+
+def token_bucket(embedder, text: str) -> int:
+    """Return the smallest token-length bucket that fits the text."""
+    num_tokens = len(embedder.tokenizer.tokenize(text))
+    for bucket in EMBED_TOKEN_BUCKETS:
+        if num_tokens <= bucket:
+            return bucket
+    return EMBED_TOKEN_BUCKETS[-1]
+
+
+@st.cache_resource
+def load_embedding_queue() -> queue.Queue:
+    """Start the background thread that batches query embeddings (cached)."""
+    embedder = load_models()
+    pending = queue.Queue()
+
+    def worker():
+        while True:
+            # Block for the first query, then collect more until the batch fills or the wait expires
+            batch = [pending.get()]
+            deadline = time.monotonic() + EMBED_BATCH_WAIT
+            while len(batch) < EMBED_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Encode each length bucket separately so one long question doesn't pad every short one
+            # (a lone query has nothing to be padded against, so skip tokenizing it twice)
+            if len(batch) == 1:
+                groups = [batch]
+            else:
+                buckets = {}
+                for item in batch:
+                    try:
+                        bucket = token_bucket(embedder, item[0])
+                    except Exception:
+                        bucket = EMBED_TOKEN_BUCKETS[-1]
+                    buckets.setdefault(bucket, []).append(item)
+                groups = buckets.values()
+
+            for items in groups:
+                try:
+                    embeddings = embedder.encode(
+                        [text for text, _ in items],
+                        batch_size=EMBED_BATCH_SIZE,
+                        normalize_embeddings=True,
+                        convert_to_numpy=True
+                    )
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+
+                # Chroma takes float32 arrays directly, so no per-float Python objects are created
+                embeddings = embeddings.astype(np.float32, copy=False)
+                for (_, future), embedding in zip(items, embeddings):
+                    future.set_result(embedding)
+
+    threading.Thread(target=worker, name="embedding-batcher", daemon=True).start()
+    return pending
+
+
+@st.cache_resource
+def load_example_embeddings() -> dict:
+    """Embed the example questions at startup (cached). Queued together, they share one batch."""
+    pending = load_embedding_queue()
+    futures = []
+    for question in EXAMPLE_QUESTIONS:
+        future = Future()
+        pending.put((question, future))
+        futures.append(future)
+    return {question: future.result() for question, future in zip(EXAMPLE_QUESTIONS, futures)}
+
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def embed_query(text: str) -> np.ndarray:
+    """Embed a query via the batching queue (cached, so repeated questions skip the model)."""
+    future = Future()
+    load_embedding_queue().put((text, future))
+    return future.result()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_indexed_filenames(doc_count: int) -> list:
+    """List the unique indexed filenames (cached; doc_count is part of the key so re-ingests refresh it)."""
+    # ingest.py's record of processed PDFs is O(#files) to read; scanning chunk metadata is O(#chunks)
+    if os.path.exists(PROCESSED_LOG):
+        with open(PROCESSED_LOG, 'r') as f:
+            return sorted(os.path.basename(path) for path in json.load(f))
+
+    _, collection = load_database()
+    all_metadata = collection.get(include=["metadatas"], limit=doc_count)
+    return sorted(set(m['filename'] for m in all_metadata['metadatas']))
+
+
+def get_ingest_mtime() -> float:
+    """Return when ingest.py last finished (mtime of PROCESSED_LOG, 0.0 if never). Part of every
+    retrieval cache key, since re-ingesting a PDF can change chunk text without changing chunk count or ids."""
+    try:
+        return os.path.getmtime(PROCESSED_LOG)
+    except OSError:
+        return 0.0
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def extract_pdf_text(pdf_bytes: bytes) -> str:
+    """Extract text from an uploaded PDF file (cached per file content)."""
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pages = [
+            f"[Page {i}]\n{text}"
+            for i, page in enumerate(doc, 1)
+            if (text := page.get_text("text").rstrip())
         ]
-    else:
-        message_content = user_text
+    return "\n\n".join(pages)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_memory_index(doc_count: int, ingest_mtime: float) -> dict:
+    """Copy every chunk out of ChromaDB into numpy for exact inner-product search (cached; doc_count and
+    ingest_mtime are part of the key so a re-ingest reloads it)."""
+    _, collection = load_database()
+    data = collection.get(include=["embeddings", "documents", "metadatas"], limit=doc_count)
+    embeddings = np.asarray(data['embeddings'], dtype=np.float32)
+    embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    return {"ids": data['ids'], "documents": data['documents'], "metadatas": data['metadatas'],
+            "embeddings": embeddings}
+
+
+def search_memory_index(index: dict, query_embedding: np.ndarray, top_k: int) -> list:
+    """Return the top_k chunks of the in-memory index by cosine similarity."""
+    scores = index['embeddings'] @ query_embedding
+    top_k = min(top_k, len(scores))
+    if top_k == 0:
+        return []
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    best = best[np.argsort(-scores[best])]
+
+    ids, docs, metas = index['ids'], index['documents'], index['metadatas']
+    return [
+        {"id": ids[i], "text": docs[i], "filename": metas[i]['filename'], "pages": metas[i]['pages'],
+         "distance": 1.0 - float(scores[i])}
+        for i in best
+    ]
+
+
+def get_relevant_chunks(query: str, collection, top_k: int = TOP_K, doc_count: int = None,
+                        with_distances: bool = True, ingest_mtime: float = 0.0) -> list:
+    """Retrieve relevant chunks, from the in-memory index when a local collection is small enough, else ChromaDB.
+    Without with_distances, ChromaDB results carry distance None."""
+    query_embedding = load_example_embeddings().get(query)
+    if query_embedding is None:
+        query_embedding = embed_query(query)
+
+    # Not in server mode: every app process would pull the whole collection over HTTP
+    if not CHROMA_HOST and doc_count and doc_count <= IN_MEMORY_INDEX_MAX_CHUNKS:
+        return search_memory_index(load_memory_index(doc_count, ingest_mtime), query_embedding, top_k)
+
+    results = collection.query(
+        query_embeddings=query_embedding.reshape(1, -1),
+        n_results=top_k,
+        include=["documents", "metadatas", "distances"] if with_distances else ["documents", "metadatas"]
+    )
+
+    # Report cosine distance; on unit vectors, squared L2 (Chroma's default space) is twice that
+    space = (collection.metadata or {}).get("hnsw:space", "l2")
+    scale = 0.5 if space == "l2" else 1.0
+
+    ids, docs, metas = results['ids'][0], results['documents'][0], results['metadatas'][0]
+    dists = results['distances'][0] if with_distances else [None] * len(ids)
+    return [
+        {"id": chunk_id, "text": doc, "filename": meta['filename'], "pages": meta['pages'],
+         "distance": dist * scale if dist is not None else None}
+        for chunk_id, doc, meta, dist in zip(ids, docs, metas, dists)
+    ]
+
+
+@st.cache_resource
+def load_paste_component():
+    """Declare the clipboard paste zone component (cached). Served from static/paste_zone/ so the browser caches it."""
+    return components.declare_component("paste_zone", path=os.path.join(APP_DIR, "static", "paste_zone"))
+
+
+@st.cache_resource
+def load_answer_cache() -> tuple:
+    """Create the answer cache shared by all sessions (cached). Returns (entries, lock)."""
+    return OrderedDict(), threading.Lock()
+
+
+def answer_cache_key(question: str, chunks: list, image_sha256: str = None, pdf_text: str = None,
+                     ingest_mtime: float = 0.0) -> tuple:
+    """Build the answer cache key from the question, retrieved chunk ids, the ingest time and attachment hashes."""
+    pdf_sha256 = hashlib.sha256(pdf_text.encode('utf-8')).hexdigest() if pdf_text else None
+    return (question, tuple(chunk['id'] for chunk in chunks), ingest_mtime, image_sha256, pdf_sha256)
+
+
+def get_cached_answer(key: tuple) -> str:
+    """Return a cached answer, or None if missing or expired."""
+    entries, lock = load_answer_cache()
+    with lock:
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        stored_at, answer = entry
+        if time.monotonic() - stored_at > ANSWER_CACHE_TTL:
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return answer
+
+
+def cache_answer(key: tuple, answer: str):
+    """Store an answer, evicting the least recently used entries beyond ANSWER_CACHE_SIZE."""
+    entries, lock = load_answer_cache()
+    with lock:
+        entries[key] = (time.monotonic(), answer)
+        entries.move_to_end(key)
+        while len(entries) > ANSWER_CACHE_SIZE:
+            entries.popitem(last=False)
+
+
+def sniff_image_type(head: bytes) -> str:
+    """Detect an image's media type from its magic bytes (None if Claude doesn't accept the format)."""
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def prepare_image(raw: bytes) -> tuple:
+    """Detect the media type of an uploaded or pasted image, shrink it for Claude and base64-encode it
+    (cached, so follow-up questions about the same image skip all of that). Returns (base64, media_type, sha256)."""
+    image_bytes, media_type = shrink_image(raw, sniff_image_type(raw[:12]))
+    return _to_b64(image_bytes), media_type, hashlib.sha256(image_bytes).hexdigest()
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def search_chunks(query: str, top_k: int, doc_count: int, ingest_mtime: float, with_distances: bool = True) -> list:
+    """Retrieve relevant chunks (cached; doc_count and ingest_mtime are part of the key so re-ingests refresh results)."""
+    _, collection = load_database()
+    return get_relevant_chunks(query, collection, top_k, doc_count, with_distances, ingest_mtime)
+
+
+def shrink_image(raw: bytes, media_type: str, max_side: int = MAX_IMAGE_SIDE) -> tuple:
+    """Downscale an image so its longest side is at most max_side and re-encode it if it's still too
+    large for the Claude API. Formats Claude doesn't accept (media_type None) are converted to PNG.
+    Returns (bytes, media_type)."""
+    img = Image.open(io.BytesIO(raw))
+    if media_type is not None and max(img.size) <= max_side and len(raw) <= MAX_IMAGE_BYTES:
+        return raw, media_type
+
+    # For JPEGs, draft() lets the decoder skip straight to a reduced scale
+    img.draft('RGB', (max_side, max_side))
+    # Re-encoding drops EXIF, so apply its orientation first (phone photos would arrive rotated)
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    output = io.BytesIO()
+    if media_type in ('image/png', 'image/gif', None):
+        # Keep graphics (charts, screenshots) lossless unless that's still over the limit
+        if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            img = img.convert('RGBA')  # e.g. CMYK TIFFs, which PNG can't store
+        img.save(output, format='PNG')
+        if output.tell() <= MAX_IMAGE_BYTES:
+            return output.getvalue(), 'image/png'
+        output = io.BytesIO()
+
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.save(output, format='JPEG', quality=JPEG_QUALITY)
+    return output.getvalue(), 'image/jpeg'
+
+
+def truncate_pdf_text(text: str) -> str:
+    """Keep the start and end of very long documents so the prompt fits the context budget."""
+    if len(text) <= MAX_PDF_CHARS:
+        return text
+    return text[:PDF_HEAD_CHARS] + "\n\n...\n[truncated]\n...\n\n" + text[-PDF_TAIL_CHARS:]
+
+
+def _to_b64(data) -> str:
+    """Return image data as a base64 string, encoding only if it arrives as raw bytes."""
+    if isinstance(data, str):
+        return data
+    return binascii.b2a_base64(data, newline=False).decode('ascii')
+
+
+def query_claude(question: str, chunks: list, image_data: bytes = None, image_type: str = None, pdf_text: str = None,
+                 outcome: dict = None):
+    """Send question and context to Claude and stream the answer with citations. Optionally include an image and/or PDF text.
+    Once the stream ends, outcome (if given) gets the response's stop_reason."""
+
+    context = "\n\n---\n\n".join(
+        f"[Source {i}: {chunk['filename']}, Page(s): {chunk['pages']}]\n{chunk['text']}"
+        for i, chunk in enumerate(chunks, 1)
+    )
+
+    user_text = USER_TEXT_TEMPLATE.format(question=question, context=context)
+
+    client = get_anthropic_client()
+
+    # Attachments go first so that follow-up questions about the same PDF or image
+    # reuse Claude's prompt cache for everything up to the last attachment
+    message_content = []
+    if pdf_text:
+        message_content.append({
+            "type": "text",
+            "text": PDF_SECTION_TEMPLATE.format(pdf_text=truncate_pdf_text(pdf_text))
+        })
+    if image_data and image_type:
+        message_content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": image_type,
+                "data": _to_b64(image_data)
+            }
+        })
+    if message_content:
+        message_content[-1]["cache_control"] = {"type": "ephemeral"}
+    message_content.append({"type": "text", "text": user_text})
 
-    response = client.messages.create(
+    with client.messages.stream(
         model="claude-sonnet-4-20250514",
-        max_tokens=2048,
-        system=system_prompt,
+        max_tokens=MAX_TOKENS,
+        system=[{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
         messages=[
             {"role": "user", "content": message_content}
         ]
-    )
+    ) as stream:
+        yield from stream.text_stream
+        if outcome is not None:
+            outcome['stop_reason'] = stream.get_final_message().stop_reason
+
+
+def clear_pasted_image():
+    """Remove pasted image button callback: replace the paste zone with a fresh, empty one."""
+    st.session_state.pop(f"paste_zone_{st.session_state.get('paste_zone_version', 0)}", None)
+    st.session_state['paste_zone_version'] = st.session_state.get('paste_zone_version', 0) + 1
 
-    return response.content[0].text
+
+def use_example_question(example: str):
+    """Example button callback: fill in the question box and answer it in the same run."""
+    st.session_state['question'] = example
+    st.session_state['run_example'] = True
+
+
+def run_query(question: str, doc_count: int, top_k: int, show_sources: bool, relevance_cutoff: float,
+              uploaded_image=None, pasted_image: str = None, uploaded_pdf=None):
+    """Retrieve sources for a question and stream Claude's answer into the page."""
+    check_relevance = relevance_cutoff < 2.0
+    ingest_mtime = get_ingest_mtime()
+
+    # First query of the process loads the embedding model (cached afterwards)
+    with st.spinner("Searching course materials..."):
+        chunks = search_chunks(question, top_k, doc_count, ingest_mtime, with_distances=check_relevance)
+
+    if show_sources:
+        with st.expander("Retrieved Sources", expanded=False):
+            for i, chunk in enumerate(chunks, 1):
+                st.markdown(f"**[{i}] {chunk['filename']}** (Page(s): {chunk['pages']})")
+                st.text(chunk['text'][:500] + "..." if len(chunk['text']) > 500 else chunk['text'])
+                st.divider()
+
+    # Prepare image data from uploaded file
+    image_data = None
+    image_type = None
+    image_sha256 = None
+
+    try:
+        if uploaded_image:
+            image_data, image_type, image_sha256 = prepare_image(uploaded_image.getvalue())
+            st.info(f"Image attached: {uploaded_image.name}")
+        elif pasted_image:
+            # Data URL from the paste zone: "data:image/png;base64,...."
+            image_bytes = binascii.a2b_base64(pasted_image.split(',', 1)[1])
+            image_data, image_type, image_sha256 = prepare_image(image_bytes)
+            st.info("Image attached: pasted screenshot")
+    except (OSError, Image.DecompressionBombError) as e:
+        # Unreadable, truncated or oversized images (UnidentifiedImageError is an OSError)
+        st.error(f"Could not read the attached image: {e}")
+        return
+
+    # Extract PDF text if uploaded
+    pdf_text = None
+    if uploaded_pdf:
+        with st.spinner("Reading PDF..."):
+            pdf_text = extract_pdf_text(uploaded_pdf.getvalue())
+        st.info(f"PDF attached: {uploaded_pdf.name} ({len(pdf_text):,} characters)")
+
+    st.divider()
+    st.subheader("Answer")
+
+    # Without attachments, Claude can only answer from the course materials
+    best_distance = min((chunk['distance'] for chunk in chunks), default=None) if check_relevance else None
+    if check_relevance and image_data is None and pdf_text is None and (best_distance is None or best_distance > relevance_cutoff):
+        st.info("No relevant material found in your indexed documents for this question. Try re-phrasing or ingest more PDFs.")
+    else:
+        answer_key = answer_cache_key(question, chunks, image_sha256, pdf_text, ingest_mtime)
+        answer = get_cached_answer(answer_key)
+        if answer is not None:
+            st.markdown(answer)
+        else:
+            outcome = {}
+            answer = st.write_stream(query_claude(question, chunks, image_data, image_type, pdf_text, outcome))
+            if outcome.get('stop_reason') == "max_tokens":
+                # Don't serve a cut-off answer from the cache; asking again gets a fresh one
+                st.warning("The answer was cut off at the length limit. Try a narrower question.")
+            else:
+                cache_answer(answer_key, answer)
 
 
 def main():
@@ -341,9 +661,8 @@ def main():
         st.info("Please set your API key in ~/.zshrc and restart the terminal.")
         st.stop()
 
-    # Load resources
-    with st.spinner("Loading models..."):
-        embedder = load_models()
+    # Load resources (the embedding model is loaded on the first query, not here)
+    with st.spinner("Loading database..."):
         client, collection = load_database()
 
     # Check database status
@@ -364,19 +683,22 @@ def main():
         st.metric("Total Chunks", doc_count)
 
         # Get unique filenames
-        all_metadata = collection.get(include=["metadatas"])
-        if all_metadata and all_metadata['metadatas']:
-            filenames = set(m['filename'] for m in all_metadata['metadatas'])
+        filenames = get_indexed_filenames(doc_count)
+        if filenames:
             st.metric("Documents", len(filenames))
 
             st.subheader("📄 Indexed Files")
-            for fname in sorted(filenames):
+            for fname in filenames:
                 st.text(f"• {fname}")
 
         st.divider()
         st.subheader("⚙️ Settings")
         top_k = st.slider("Number of sources to retrieve", 3, 10, TOP_K)
         show_sources = st.checkbox("Show retrieved sources", value=False)
+        relevance_cutoff = st.slider(
+            "Relevance cutoff (cosine distance)", 0.3, 2.0, RELEVANCE_CUTOFF, 0.05,
+            help="Text-only questions whose closest source is farther than this are not sent to Claude. 2.0 turns the check off."
+        )
 
         st.divider()
         st.subheader("🔄 Re-index")
@@ -389,6 +711,7 @@ def main():
     # Query input
     question = st.text_input(
         "🔍 Ask a question about your course materials:",
+        key="question",
         placeholder="e.g., What is the difference between a treemap and a sunburst chart?"
     )
 
@@ -405,6 +728,13 @@ def main():
         if uploaded_image:
             st.image(uploaded_image, caption="Uploaded image", width=300)
 
+        # The component keeps its value for the session; a new key remounts it empty
+        paste_zone = load_paste_component()
+        paste_version = st.session_state.get('paste_zone_version', 0)
+        pasted_image = paste_zone(key=f"paste_zone_{paste_version}", default=None)
+        if pasted_image:
+            st.button("Remove pasted image", on_click=clear_pasted_image)
+
     with col_pdf:
         st.markdown("**Upload a PDF (optional):**")
         uploaded_pdf = st.file_uploader(
@@ -415,65 +745,19 @@ def main():
         if uploaded_pdf:
             st.success(f"Attached: {uploaded_pdf.name}")
 
-    if st.button("Get Answer", type="primary"):
+    get_answer = st.button("Get Answer", type="primary")
+    if st.session_state.pop('run_example', False) or get_answer:
         if question:
             st.session_state['last_question'] = question
-
-            with st.spinner("Searching course materials..."):
-                chunks = get_relevant_chunks(question, embedder, collection, top_k)
-
-            if show_sources:
-                with st.expander("Retrieved Sources", expanded=False):
-                    for i, chunk in enumerate(chunks, 1):
-                        st.markdown(f"**[{i}] {chunk['filename']}** (Page(s): {chunk['pages']})")
-                        st.text(chunk['text'][:500] + "..." if len(chunk['text']) > 500 else chunk['text'])
-                        st.divider()
-
-            # Prepare image data from uploaded file
-            image_data = None
-            image_type = None
-
-            if uploaded_image:
-                image_data = uploaded_image.getvalue()
-                ext = uploaded_image.name.split('.')[-1].lower()
-                mime_map = {
-                    'png': 'image/png',
-                    'jpg': 'image/jpeg',
-                    'jpeg': 'image/jpeg',
-                    'gif': 'image/gif',
-                    'webp': 'image/webp'
-                }
-                image_type = mime_map.get(ext, 'image/png')
-                st.info(f"Image attached: {uploaded_image.name}")
-
-            # Extract PDF text if uploaded
-            pdf_text = None
-            if uploaded_pdf:
-                with st.spinner("Reading PDF..."):
-                    pdf_text = extract_pdf_text(uploaded_pdf)
-                st.info(f"PDF attached: {uploaded_pdf.name} ({len(pdf_text):,} characters)")
-
-            with st.spinner("Generating answer..."):
-                answer = query_claude(question, chunks, image_data, image_type, pdf_text)
-
-            st.divider()
-            st.subheader("Answer")
-            st.markdown(answer)
+            run_query(question, doc_count, top_k, show_sources, relevance_cutoff,
+                      uploaded_image, pasted_image, uploaded_pdf)
 
     # Example questions
     st.divider()
     st.subheader("💭 Example Questions")
-    col1, col2 = st.columns(2)
-
-    with col1:
-        if st.button("What visualization is best for hierarchical data?"):
-            st.session_state['example_q'] = "What visualization is best for hierarchical data?"
-            st.rerun()
-
-    with col2:
-        if st.button("Explain the principles of visual encoding"):
-            st.session_state['example_q'] = "Explain the principles of visual encoding"
-            st.rerun()
+    for col, example in zip(st.columns(len(EXAMPLE_QUESTIONS)), EXAMPLE_QUESTIONS):
+        with col:
+            st.button(example, on_click=use_example_question, args=(example,))
 
 
 if __name__ == "__main__":
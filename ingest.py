@@ -8,19 +8,25 @@ Images are analyzed by Claude and their descriptions become searchable.
 import os
 import io
 import json
+import queue
 import hashlib
-import base64
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from typing import List, Dict, Any
 
-import fitz  # PyMuPDF
-import chromadb
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
-import anthropic
 from PIL import Image
 from dotenv import load_dotenv
 
+from pdf_extract import process_one_pdf
+
+try:
+    import pybase64 as base64  # optional SIMD-accelerated drop-in for the standard library module
+except ImportError:
+    import base64
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -30,30 +36,100 @@ MAX_IMAGE_BYTES = 4_500_000
 # Configuration
 PDF_FOLDER = os.path.expanduser("~/Library/Mobile Documents/com~apple~CloudDocs/StudyPDFs")
 CHROMA_PATH = os.path.expanduser("~/Desktop/StudyAssistant/chroma_db")
+CHROMA_HOST = os.environ.get("CHROMA_HOST")  # set to write to a `chroma run` server instead of CHROMA_PATH
+CHROMA_PORT = int(os.environ.get("CHROMA_PORT", "8000"))
 PROCESSED_LOG = os.path.expanduser("~/Desktop/StudyAssistant/.processed_files.json")
+IMAGE_DESCRIPTIONS_LOG = os.path.expanduser("~/Desktop/StudyAssistant/.image_descriptions.json")
+EMBEDDING_CACHE = os.path.expanduser("~/Desktop/StudyAssistant/.embedding_cache.sqlite")
 COLLECTION_NAME = "study_materials"
-
-# Chunking parameters
-CHUNK_SIZE = 1000  # characters
-CHUNK_OVERLAP = 200  # characters
-
-# Image extraction parameters
-MIN_IMAGE_SIZE = 10000  # Minimum bytes for an image to be worth analyzing
-MIN_IMAGE_DIMENSION = 100  # Minimum width/height in pixels
+EMBEDDING_MODEL = "all-mpnet-base-v2"
+
+# CPU embedding backend: "torch", or "onnx" / "openvino" to run the hub's INT8-quantized export
+# (needs `pip install "sentence-transformers[onnx]"` or `"sentence-transformers[openvino]"`).
+# Keep in step with EMBEDDING_BACKEND in app.py so documents and queries are embedded by the same model.
+EMBEDDING_BACKEND = "torch"
+QUANTIZED_MODEL_FILES = {
+    "onnx": "onnx/model_qint8_avx512_vnni.onnx",
+    "openvino": "openvino/openvino_model_qint8_quantized.xml",
+}
+EMBED_BATCH_SIZE = 128
+ADD_BATCH_SIZE = 256  # chunks per ChromaDB write (and per embedding call)
+PIPELINE_QUEUE_SIZE = 8  # items buffered between ingest pipeline stages
+
+# HNSW index parameters (only applied when the collection is first created)
+COLLECTION_METADATA = {
+    "description": "Study materials for RAG",
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,  # higher = better recall, query latency grows roughly linearly
+}
+
+# PDFs are extracted in parallel by up to this many worker processes
+MAX_PDF_WORKERS = 6
+
+# Concurrent Claude requests when describing images (rate-limit retries are left to the SDK)
+MAX_IMAGE_WORKERS = 8
+CLAUDE_MAX_RETRIES = 5
+
+
+# torch, sentence_transformers, numpy, chromadb and anthropic are imported inside the functions that use them:
+# the PDF worker processes re-import this module on macOS (spawn) and only need pdf_extract.
+
+
+def pick_device() -> str:
+    """Pick the fastest available device for the embedding model."""
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def load_embedder() -> "SentenceTransformer":
+    """Load the embedding model: the configured ONNX/OpenVINO backend on CPU, FP16 on CUDA/MPS
+    (falling back to PyTorch FP32 if either can't run)."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    device = pick_device()
+    if device == "cpu":
+        if EMBEDDING_BACKEND in QUANTIZED_MODEL_FILES:
+            try:
+                return SentenceTransformer(
+                    EMBEDDING_MODEL,
+                    device=device,
+                    backend=EMBEDDING_BACKEND,
+                    model_kwargs={"file_name": QUANTIZED_MODEL_FILES[EMBEDDING_BACKEND]}
+                )
+            except Exception as e:
+                print(f"Warning: Could not load {EMBEDDING_BACKEND} embedding backend, using PyTorch: {e}")
+        return SentenceTransformer(EMBEDDING_MODEL, device=device)
+    try:
+        embedder = SentenceTransformer(EMBEDDING_MODEL, device=device, model_kwargs={"torch_dtype": torch.float16})
+        embedder.encode("warm up")
+        return embedder
+    except Exception:
+        return SentenceTransformer(EMBEDDING_MODEL, device=device)
 
 
 def get_file_hash(filepath: str) -> str:
     """Generate MD5 hash of file for change detection."""
-    hasher = hashlib.md5()
     with open(filepath, 'rb') as f:
-        buf = f.read(65536)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = f.read(65536)
-    return hasher.hexdigest()
+        return hashlib.file_digest(f, 'md5').hexdigest()
+
 
+def file_signature(filepath: str, previous) -> dict:
+    """Return {mtime, size, hash} for a file, reusing the previous record's hash if mtime and size are unchanged."""
+    stat = os.stat(filepath)
+    if isinstance(previous, dict) and previous.get("mtime") == stat.st_mtime and previous.get("size") == stat.st_size:
+        return previous
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "hash": get_file_hash(filepath)}
 
-def load_processed_files() -> Dict[str, str]:
+
+def load_processed_files() -> Dict[str, Any]:
     """Load record of previously processed files."""
     if os.path.exists(PROCESSED_LOG):
         with open(PROCESSED_LOG, 'r') as f:
@@ -61,12 +137,26 @@ def load_processed_files() -> Dict[str, str]:
     return {}
 
 
-def save_processed_files(processed: Dict[str, str]):
+def save_processed_files(processed: Dict[str, Any]):
     """Save record of processed files."""
     with open(PROCESSED_LOG, 'w') as f:
         json.dump(processed, f, indent=2)
 
 
+def load_image_descriptions() -> Dict[str, str]:
+    """Load Claude's image descriptions from previous ingests, keyed by image content hash."""
+    if os.path.exists(IMAGE_DESCRIPTIONS_LOG):
+        with open(IMAGE_DESCRIPTIONS_LOG, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_image_descriptions(descriptions: Dict[str, str]):
+    """Save the image description cache."""
+    with open(IMAGE_DESCRIPTIONS_LOG, 'w') as f:
+        json.dump(descriptions, f, indent=2)
+
+
 def resize_image_if_needed(image_bytes: bytes, max_bytes: int = MAX_IMAGE_BYTES) -> bytes:
     """Resize image if it exceeds the maximum size for Claude API."""
     if len(image_bytes) <= max_bytes:
@@ -76,22 +166,22 @@ def resize_image_if_needed(image_bytes: bytes, max_bytes: int = MAX_IMAGE_BYTES)
     img = Image.open(io.BytesIO(image_bytes))
 
     # Convert to RGB if necessary (for PNG with transparency)
-    if img.mode in ('RGBA', 'P'):
+    if img.mode in ('RGBA', 'LA', 'P'):
         img = img.convert('RGB')
 
-    # Iteratively reduce size until under limit
+    # Iteratively reduce size until under limit, shrinking the previous step's image each time
     quality = 85
     scale = 1.0
 
     while len(image_bytes) > max_bytes and scale > 0.1:
-        # Reduce dimensions
+        # Reduce dimensions (a 0.8x step is mild enough for bilinear filtering)
         scale *= 0.8
-        new_size = (int(img.width * scale), int(img.height * scale))
-        resized = img.resize(new_size, Image.Resampling.LANCZOS)
+        new_size = (max(1, int(img.width * 0.8)), max(1, int(img.height * 0.8)))
+        img = img.resize(new_size, Image.Resampling.BILINEAR)
 
-        # Save to bytes
+        # Save to bytes (skip the extra Huffman optimization pass; the loop checks the size anyway)
         output = io.BytesIO()
-        resized.save(output, format='JPEG', quality=quality, optimize=True)
+        img.save(output, format='JPEG', quality=quality, optimize=False)
         image_bytes = output.getvalue()
 
         # Also try reducing quality
@@ -101,11 +191,9 @@ def resize_image_if_needed(image_bytes: bytes, max_bytes: int = MAX_IMAGE_BYTES)
     return image_bytes
 
 
-def describe_image_with_claude(image_bytes: bytes, filename: str, page_num: int) -> str:
+def describe_image_with_claude(client: "anthropic.Anthropic", image_bytes: bytes) -> str:
     """Use Claude to describe an image for searchability."""
     try:
-        client = anthropic.Anthropic()
-
         # Resize if too large for Claude API
         image_bytes = resize_image_if_needed(image_bytes)
 
@@ -113,7 +201,7 @@ def describe_image_with_claude(image_bytes: bytes, filename: str, page_num: int)
         media_type = "image/jpeg" if image_bytes[:2] == b'\xff\xd8' else "image/png"
 
         # Encode image as base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        image_base64 = base64.b64encode(image_bytes).decode('ascii')
 
         response = client.messages.create(
             model="claude-sonnet-4-20250514",
@@ -147,165 +235,108 @@ Be concise but thorough. This description will be used for text search."""
             ]
         )
 
-        description = response.content[0].text
-        return f"[IMAGE/FIGURE from {filename}, Page {page_num}]\n{description}"
+        return response.content[0].text
 
     except Exception as e:
         print(f"      Warning: Could not analyze image: {e}")
         return None
 
 
-def extract_images_from_pdf(pdf_path: str, filename: str) -> List[Dict[str, Any]]:
-    """Extract significant images from PDF and get Claude descriptions."""
-    images = []
-    doc = fitz.open(pdf_path)
+def open_embedding_cache() -> sqlite3.Connection:
+    """Open the embedding cache, which maps a hash of model + chunk text to its float32 vector."""
+    conn = sqlite3.connect(EMBEDDING_CACHE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+    return conn
 
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        image_list = page.get_images()
 
-        for img_index, img in enumerate(image_list):
-            try:
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-
-                # Check if image is significant enough
-                if len(image_bytes) < MIN_IMAGE_SIZE:
-                    continue
-
-                # Check dimensions
-                width = base_image.get("width", 0)
-                height = base_image.get("height", 0)
-                if width < MIN_IMAGE_DIMENSION or height < MIN_IMAGE_DIMENSION:
-                    continue
-
-                # Convert to PNG if needed for Claude
-                if base_image["ext"] != "png":
-                    # Use fitz to convert
-                    pix = fitz.Pixmap(doc, xref)
-                    if pix.n > 4:  # CMYK
-                        pix = fitz.Pixmap(fitz.csRGB, pix)
-                    image_bytes = pix.tobytes("png")
-
-                images.append({
-                    "page_num": page_num + 1,
-                    "image_bytes": image_bytes,
-                    "img_index": img_index
-                })
+def embed_with_cache(embedder: "SentenceTransformer", cache: sqlite3.Connection, texts: List[str]) -> "np.ndarray":
+    """Embed texts, reusing vectors from earlier ingests (unchanged chunks of an edited PDF) and caching new ones."""
+    import numpy as np
 
-            except Exception as e:
-                continue
-
-    doc.close()
-    return images
-
-
-def extract_text_from_pdf(pdf_path: str) -> List[Dict[str, Any]]:
-    """
-    Extract text from PDF with page numbers.
-    Handles tables by extracting text in reading order.
-    Returns list of {page_num, text} dicts.
-    """
-    pages = []
-    doc = fitz.open(pdf_path)
-
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-
-        # Extract text - use "text" mode which handles tables reasonably
-        text = page.get_text("text")
-
-        # Also try to extract any tables as structured text
-        tables = page.find_tables()
-        table_text = ""
-        if tables:
-            for table in tables:
-                try:
-                    df = table.to_pandas()
-                    table_text += "\n" + df.to_string(index=False) + "\n"
-                except:
-                    pass
-
-        combined_text = text.strip()
-        if table_text.strip():
-            combined_text += "\n\n[TABLE DATA]\n" + table_text.strip()
-
-        if combined_text:
-            pages.append({
-                "page_num": page_num + 1,
-                "text": combined_text
-            })
-
-    doc.close()
-    return pages
-
-
-def chunk_text(pages: List[Dict[str, Any]], filename: str) -> List[Dict[str, Any]]:
-    """
-    Chunk text with overlap, preserving page number attribution.
-    """
-    chunks = []
+    model_id = f"{EMBEDDING_MODEL}:{EMBEDDING_BACKEND}\0".encode('utf-8')
+    keys = [hashlib.blake2b(model_id + text.encode('utf-8'), digest_size=16).digest() for text in texts]
+
+    placeholders = ",".join("?" * len(keys))
+    rows = cache.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys)
+    vectors = {key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows}
 
-    full_text = ""
-    page_positions = []
-
-    for page_data in pages:
-        page_positions.append({
-            "page_num": page_data["page_num"],
-            "start_pos": len(full_text)
-        })
-        full_text += page_data["text"] + "\n\n"
-
-    if page_positions:
-        page_positions.append({
-            "page_num": page_positions[-1]["page_num"],
-            "start_pos": len(full_text)
-        })
-
-    start = 0
-    chunk_id = 0
-
-    while start < len(full_text):
-        end = start + CHUNK_SIZE
-
-        if end < len(full_text):
-            for sep in ['. ', '.\n', '? ', '?\n', '! ', '!\n']:
-                last_sep = full_text[start:end].rfind(sep)
-                if last_sep != -1 and last_sep > CHUNK_SIZE // 2:
-                    end = start + last_sep + len(sep)
-                    break
-
-        chunk_text_content = full_text[start:end].strip()
-
-        if chunk_text_content:
-            chunk_pages = set()
-            for i, pos in enumerate(page_positions[:-1]):
-                next_pos = page_positions[i + 1]["start_pos"]
-                if start < next_pos and end > pos["start_pos"]:
-                    chunk_pages.add(pos["page_num"])
-
-            chunks.append({
-                "id": f"{filename}_{chunk_id}",
-                "text": chunk_text_content,
-                "filename": filename,
-                "pages": sorted(list(chunk_pages)),
-                "page_str": ", ".join(map(str, sorted(chunk_pages))),
-                "type": "text"
-            })
-            chunk_id += 1
-
-        start = end - CHUNK_OVERLAP
-        if start < 0:
-            start = 0
-        if start >= len(full_text):
-            break
-
-    return chunks
+    missing = [i for i, key in enumerate(keys) if key not in vectors]
+    if missing:
+        # Unit vectors, so the collection's cosine space reduces to a dot product.
+        # encode() already sorts by length internally, so batches are padded to similar lengths.
+        embeddings = embedder.encode(
+            [texts[i] for i in missing],
+            batch_size=EMBED_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).astype(np.float32)
+        new = [(keys[i], embedding) for i, embedding in zip(missing, embeddings)]
+        cache.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                          [(key, embedding.tobytes()) for key, embedding in new])
+        cache.commit()
+        vectors.update(new)
+
+    return np.stack([vectors[key] for key in keys])
+
+
+def encode_chunks(embedder: "SentenceTransformer", chunk_queue: queue.Queue, write_queue: queue.Queue):
+    """Pipeline stage: embed chunk lists from chunk_queue in ADD_BATCH_SIZE batches and pass them to write_queue."""
+    chunks = []
+    cache = None
+    try:
+        cache = open_embedding_cache()  # sqlite connections stay on the thread that opened them
+        pending = []
+        while True:
+            chunks = chunk_queue.get()
+            if chunks is not None:
+                pending.extend(chunks)
+            while len(pending) >= ADD_BATCH_SIZE or (chunks is None and pending):
+                batch, pending = pending[:ADD_BATCH_SIZE], pending[ADD_BATCH_SIZE:]
+                embeddings = embed_with_cache(embedder, cache, [chunk["text"] for chunk in batch])
+                write_queue.put((batch, embeddings))
+            if chunks is None:
+                return
+    except:
+        # Keep draining so the producer never blocks on a full queue, then report the error
+        while chunks is not None:
+            chunks = chunk_queue.get()
+        raise
+    finally:
+        if cache is not None:
+            cache.close()
+        write_queue.put(None)
+
+
+def store_chunks(collection, write_queue: queue.Queue, progress: tqdm):
+    """Pipeline stage: write embedded batches from write_queue to ChromaDB."""
+    try:
+        while (item := write_queue.get()) is not None:
+            batch, embeddings = item
+            collection.upsert(
+                ids=[chunk["id"] for chunk in batch],
+                embeddings=embeddings,
+                documents=[chunk["text"] for chunk in batch],
+                metadatas=[{
+                    "filename": chunk["filename"],
+                    "pages": chunk["page_str"],
+                    "page_list": ",".join(map(str, chunk["pages"])),
+                    "type": chunk.get("type", "text")
+                } for chunk in batch]
+            )
+            progress.update(len(batch))
+    except:
+        while write_queue.get() is not None:
+            pass
+        raise
 
 
 def ingest_pdfs(extract_images: bool = True):
     """Main ingestion function."""
+    import anthropic
+    import chromadb
+
     print("=" * 60)
     print("Study Assistant - PDF Ingestion")
     print("=" * 60)
@@ -343,109 +374,150 @@ def ingest_pdfs(extract_images: bool = True):
     # Check which files need processing
     files_to_process = []
     for pdf_path in pdf_files:
-        file_hash = get_file_hash(str(pdf_path))
-        if str(pdf_path) not in processed_files or processed_files[str(pdf_path)] != file_hash:
-            files_to_process.append((pdf_path, file_hash))
+        # Older records store just the hash; those files get hashed once and upgraded
+        previous = processed_files.get(str(pdf_path))
+        signature = file_signature(str(pdf_path), previous)
+        previous_hash = previous.get("hash") if isinstance(previous, dict) else previous
+        if previous_hash != signature["hash"]:
+            files_to_process.append((pdf_path, signature))
         else:
+            processed_files[str(pdf_path)] = signature
             print(f"  Skipping (unchanged): {pdf_path.name}")
 
     if not files_to_process:
+        save_processed_files(processed_files)  # keep upgraded records and refreshed mtimes
         print("\nAll files already processed. No updates needed.")
         return
 
     print(f"\nProcessing {len(files_to_process)} new/modified file(s)...")
 
-    # Initialize embedding model
-    print("\nLoading embedding model...")
-    embedder = SentenceTransformer('all-mpnet-base-v2')
-
-    # Initialize ChromaDB
-    print("Initializing vector database...")
-    os.makedirs(CHROMA_PATH, exist_ok=True)
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-
-    collection = client.get_or_create_collection(
-        name=COLLECTION_NAME,
-        metadata={"description": "Study materials for RAG"}
-    )
-
-    # Process each PDF
-    all_chunks = []
-    for pdf_path, file_hash in tqdm(files_to_process, desc="Processing PDFs"):
-        filename = pdf_path.name
-        print(f"\n  Extracting: {filename}")
-
-        # Extract text
-        pages = extract_text_from_pdf(str(pdf_path))
-        print(f"    - {len(pages)} pages extracted")
-
-        # Chunk text
-        chunks = chunk_text(pages, filename)
-        print(f"    - {len(chunks)} text chunks created")
-
-        # Extract and analyze images
-        if extract_images:
-            print(f"    - Extracting images...")
-            images = extract_images_from_pdf(str(pdf_path), filename)
-            print(f"    - {len(images)} significant images found")
-
-            if images:
-                print(f"    - Analyzing images with Claude...")
-                for img_data in tqdm(images, desc="      Analyzing", leave=False):
-                    description = describe_image_with_claude(
-                        img_data["image_bytes"],
-                        filename,
-                        img_data["page_num"]
-                    )
-                    if description:
-                        chunks.append({
-                            "id": f"{filename}_img_{img_data['page_num']}_{img_data['img_index']}",
-                            "text": description,
-                            "filename": filename,
-                            "pages": [img_data["page_num"]],
-                            "page_str": str(img_data["page_num"]),
-                            "type": "image"
-                        })
-                print(f"    - {len([c for c in chunks if c.get('type') == 'image'])} image descriptions added")
-
-        # Remove old chunks for this file
+    # Start the PDF workers before loading the model or starting any threads: forked workers (Linux)
+    # then inherit neither, and extraction overlaps with the setup below
+    num_workers = min(os.cpu_count() or 1, MAX_PDF_WORKERS, len(files_to_process))
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        # At most num_workers PDFs are in flight, so finished extractions never pile up in memory
+        # while the pipeline below is busy
+        remaining = deque(files_to_process)
+        futures = {}
+
+        def submit_next():
+            if remaining:
+                pdf_path, signature = remaining.popleft()
+                futures[pool.submit(process_one_pdf, str(pdf_path), pdf_path.name, extract_images)] = (pdf_path, signature)
+
+        for _ in range(num_workers):
+            submit_next()
+
+        # Initialize embedding model
+        print("\nLoading embedding model...")
+        embedder = load_embedder()
+
+        # Initialize ChromaDB
+        print("Initializing vector database...")
+        if CHROMA_HOST:
+            client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        else:
+            os.makedirs(CHROMA_PATH, exist_ok=True)
+            client = chromadb.PersistentClient(path=CHROMA_PATH)
+
+        # Don't pass metadata to an existing collection: its index was built with its own HNSW settings
         try:
-            existing = collection.get(where={"filename": filename})
-            if existing and existing['ids']:
-                collection.delete(ids=existing['ids'])
-                print(f"    - Removed {len(existing['ids'])} old chunks")
+            collection = client.get_collection(name=COLLECTION_NAME)
+        except:
+            collection = client.create_collection(
+                name=COLLECTION_NAME,
+                metadata=COLLECTION_METADATA
+            )
+
+        # One client for all image descriptions (reuses connections across threads)
+        claude = anthropic.Anthropic(max_retries=CLAUDE_MAX_RETRIES) if extract_images else None
+        image_descriptions = load_image_descriptions() if extract_images else {}
+
+        # Remove old chunks of every re-processed file in one call (also drops chunks a shorter new version no longer has)
+        try:
+            collection.delete(where={"filename": {"$in": [pdf_path.name for pdf_path, _ in files_to_process]}})
         except:
             pass
 
-        all_chunks.extend(chunks)
-        processed_files[str(pdf_path)] = file_hash
-
-    # Generate embeddings and store
-    if all_chunks:
-        print(f"\nGenerating embeddings for {len(all_chunks)} chunks...")
-        texts = [chunk["text"] for chunk in all_chunks]
-        embeddings = embedder.encode(texts, show_progress_bar=True)
-
-        print("Storing in vector database...")
-        collection.add(
-            ids=[chunk["id"] for chunk in all_chunks],
-            embeddings=embeddings.tolist(),
-            documents=texts,
-            metadatas=[{
-                "filename": chunk["filename"],
-                "pages": chunk["page_str"],
-                "page_list": ",".join(map(str, chunk["pages"])),
-                "type": chunk.get("type", "text")
-            } for chunk in all_chunks]
-        )
+        # Pipeline: worker processes extract and chunk PDFs while this process describes images,
+        # one thread embeds finished chunks and another writes them to the database
+        chunk_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        write_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        store_progress = tqdm(desc="Storing chunks", unit="chunk", position=1)
+        text_chunks = 0
+        image_chunks = 0
+
+        pdf_progress = tqdm(total=len(files_to_process), desc="Processing PDFs", position=0)
+
+        with ThreadPoolExecutor(max_workers=2) as stages:
+            encoder = stages.submit(encode_chunks, embedder, chunk_queue, write_queue)
+            writer = stages.submit(store_chunks, collection, write_queue, store_progress)
+
+            try:
+                with ThreadPoolExecutor(max_workers=MAX_IMAGE_WORKERS) as image_pool:
+                    while futures:
+                        future = wait(futures, return_when=FIRST_COMPLETED).done.pop()
+                        pdf_path, signature = futures.pop(future)
+                        submit_next()
+                        filename = pdf_path.name
+                        num_pages, chunks, images = future.result()
+                        del future  # holds the result; drop it so this PDF is freed once its chunks are stored
+                        print(f"\n  Extracted: {filename}")
+                        print(f"    - {num_pages} pages extracted")
+                        print(f"    - {len(chunks)} text chunks created")
+                        text_chunks += len(chunks)
+
+                        # Analyze images
+                        if extract_images:
+                            print(f"    - {len(images)} significant images found")
+
+                            # Figures reused across slide decks or re-ingests are only described once
+                            to_describe = [img_data for img_data in images if img_data["hash"] not in image_descriptions]
+                            if to_describe:
+                                print(f"    - Analyzing {len(to_describe)} images with Claude ({len(images) - len(to_describe)} cached)...")
+                                descriptions = image_pool.map(
+                                    lambda img_data: describe_image_with_claude(claude, img_data["image_bytes"]),
+                                    to_describe
+                                )
+                                for img_data, description in tqdm(zip(to_describe, descriptions), total=len(to_describe),
+                                                                  desc="      Analyzing", leave=False):
+                                    if description:
+                                        image_descriptions[img_data["hash"]] = description
+                                save_image_descriptions(image_descriptions)
+
+                            if images:
+                                for img_data in images:
+                                    description = image_descriptions.get(img_data["hash"])
+                                    if description:
+                                        page_str = ", ".join(map(str, img_data["pages"]))
+                                        chunks.append({
+                                            "id": f"{filename}_img_{img_data['page_num']}_{img_data['img_index']}",
+                                            "text": f"[IMAGE/FIGURE from {filename}, Page {page_str}]\n{description}",
+                                            "filename": filename,
+                                            "pages": img_data["pages"],
+                                            "page_str": page_str,
+                                            "type": "image"
+                                        })
+                                        image_chunks += 1
+                                print(f"    - {len([c for c in chunks if c.get('type') == 'image'])} image descriptions added")
+
+                        chunk_queue.put(chunks)
+                        del chunks, images
+                        processed_files[str(pdf_path)] = signature
+                        pdf_progress.update(1)
+            finally:
+                chunk_queue.put(None)
+
+            # Re-raise any embedding or database error before recording files as processed
+            encoder.result()
+            writer.result()
+        pdf_progress.close()
+        store_progress.close()
 
     # Save processed files record
     save_processed_files(processed_files)
 
     # Summary
-    text_chunks = len([c for c in all_chunks if c.get("type", "text") == "text"])
-    image_chunks = len([c for c in all_chunks if c.get("type") == "image"])
-
     print("\n" + "=" * 60)
     print("Ingestion complete!")
     print(f"  - Text chunks added: {text_chunks}")
@@ -0,0 +1,209 @@
+"""
+PDF extraction and chunking for Study Assistant.
+Kept free of the embedding, database and API packages: ingest.py runs these functions
+in worker processes, and each worker only has to import PyMuPDF.
+"""
+
+import bisect
+import hashlib
+import re
+from typing import List, Dict, Any
+
+import fitz  # PyMuPDF
+
+# Don't print MuPDF's warnings about malformed PDFs to stderr (they are still collected in fitz.TOOLS)
+fitz.TOOLS.mupdf_display_errors(False)
+
+# Chunking parameters
+CHUNK_SIZE = 1000  # characters
+CHUNK_OVERLAP = 200  # characters
+SENTENCE_END = re.compile(r'[.?!][ \n]')  # chunks prefer to end right after one of these
+
+# Image extraction parameters
+MIN_IMAGE_SIZE = 10000  # Minimum bytes for an image to be worth analyzing
+MIN_IMAGE_DIMENSION = 100  # Minimum width/height in pixels
+
+
+def might_have_tables(page) -> bool:
+    """Cheap check for the ruling lines find_tables() looks for: a table needs at least two horizontal edges."""
+    edges = 0
+    for drawing in page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "l" and abs(item[1].y - item[2].y) < 1:
+                edges += 1
+            elif item[0] in ("re", "qu"):
+                edges += 2
+            if edges >= 2:
+                return True
+    return False
+
+
+def add_image_page(image: Dict[str, Any], page_num: int):
+    """Record another page on which an already extracted image appears."""
+    if image["pages"][-1] != page_num:
+        image["pages"].append(page_num)
+
+
+def extract_pdf_content(pdf_path: str, extract_images: bool = True) -> tuple:
+    """
+    Extract text and significant images from a PDF in one pass over its pages.
+    Handles tables by extracting text in reading order.
+    Images repeated across pages (logos, recurring figures) are returned once, with every page they appear on.
+    Returns (pages, images): lists of {page_num, text} and {page_num, pages, image_bytes, img_index, hash} dicts.
+    """
+    pages = []
+    images = []
+    seen_xrefs = {}  # xref -> index into images, or None if the image was skipped
+    seen_hashes = {}  # content hash -> index into images
+    doc = fitz.open(pdf_path)
+
+    for page_num in range(len(doc)):
+        page = doc[page_num]
+
+        # Extract text - use "text" mode which handles tables reasonably
+        text = page.get_text("text")
+
+        # Also try to extract any tables as structured text (tab-separated rows, no pandas)
+        tables = page.find_tables().tables if might_have_tables(page) else []
+        table_text = ""
+        for table in tables:
+            try:
+                rows = table.extract()
+                table_text += "\n" + "\n".join("\t".join(cell or "" for cell in row) for row in rows) + "\n"
+            except:
+                pass
+
+        combined_text = text.strip()
+        if table_text.strip():
+            combined_text += "\n\n[TABLE DATA]\n" + table_text.strip()
+
+        if combined_text:
+            pages.append({
+                "page_num": page_num + 1,
+                "text": combined_text
+            })
+
+        if not extract_images:
+            continue
+
+        # get_images() tuples are (xref, smask, width, height, ...) read from the image dictionaries,
+        # so small icons are skipped without extracting them
+        for img_index, img in enumerate(page.get_images()):
+            try:
+                xref = img[0]
+                if xref in seen_xrefs:
+                    if seen_xrefs[xref] is not None:
+                        add_image_page(images[seen_xrefs[xref]], page_num + 1)
+                    continue
+                seen_xrefs[xref] = None
+
+                # Check dimensions
+                if img[2] < MIN_IMAGE_DIMENSION or img[3] < MIN_IMAGE_DIMENSION:
+                    continue
+
+                base_image = doc.extract_image(xref)
+                image_bytes = base_image["image"]
+
+                # Check if image is significant enough
+                if len(image_bytes) < MIN_IMAGE_SIZE:
+                    continue
+
+                # Hash the embedded bytes, so cached descriptions survive changes to the conversion below
+                image_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+                # Same bytes stored under another xref
+                if image_hash in seen_hashes:
+                    seen_xrefs[xref] = seen_hashes[image_hash]
+                    add_image_page(images[seen_hashes[image_hash]], page_num + 1)
+                    continue
+
+                # PNG and grayscale/RGB JPEG go to Claude as-is; anything else is re-encoded as JPEG
+                ext = base_image["ext"]
+                if not (ext == "png" or (ext in ("jpeg", "jpg") and base_image.get("colorspace") in (1, 3))):
+                    pix = fitz.Pixmap(doc, xref)
+                    if pix.n - pix.alpha >= 4:  # CMYK
+                        pix = fitz.Pixmap(fitz.csRGB, pix)
+                    if pix.alpha:
+                        pix = fitz.Pixmap(pix, 0)  # JPEG has no alpha channel
+                    image_bytes = pix.tobytes("jpeg", jpg_quality=85)
+                    del pix  # free the native buffer now rather than at the next GC
+
+                seen_xrefs[xref] = seen_hashes[image_hash] = len(images)
+                images.append({
+                    "page_num": page_num + 1,
+                    "pages": [page_num + 1],
+                    "image_bytes": image_bytes,
+                    "img_index": img_index,
+                    "hash": image_hash
+                })
+
+            except Exception as e:
+                continue
+
+    doc.close()
+    return pages, images
+
+
+def chunk_text(pages: List[Dict[str, Any]], filename: str) -> List[Dict[str, Any]]:
+    """
+    Chunk text with overlap, preserving page number attribution.
+    """
+    chunks = []
+
+    # Join once instead of growing one string page by page; track each page's offset as we go
+    page_texts = [page_data["text"] + "\n\n" for page_data in pages]
+    page_nums = [page_data["page_num"] for page_data in pages]
+    page_starts = []
+    offset = 0
+    for text in page_texts:
+        page_starts.append(offset)
+        offset += len(text)
+    full_text = "".join(page_texts)
+
+    # End positions of every sentence boundary, found in one pass
+    boundaries = [m.end() for m in SENTENCE_END.finditer(full_text)]
+
+    start = 0
+    chunk_id = 0
+
+    while start < len(full_text):
+        end = start + CHUNK_SIZE
+
+        # Break after the last sentence end in the second half of the window
+        if end < len(full_text):
+            i = bisect.bisect_right(boundaries, end) - 1
+            if i >= 0 and boundaries[i] > start + CHUNK_SIZE // 2 + 2:
+                end = boundaries[i]
+
+        chunk_text_content = full_text[start:end].strip()
+
+        if chunk_text_content:
+            # Pages overlapping [start, end)
+            first = bisect.bisect_right(page_starts, start) - 1
+            last = bisect.bisect_left(page_starts, end) - 1
+            chunk_pages = page_nums[first:last + 1]
+
+            chunks.append({
+                "id": f"{filename}_{chunk_id}",
+                "text": chunk_text_content,
+                "filename": filename,
+                "pages": chunk_pages,
+                "page_str": ", ".join(map(str, chunk_pages)),
+                "type": "text"
+            })
+            chunk_id += 1
+
+        start = end - CHUNK_OVERLAP
+        if start < 0:
+            start = 0
+        if start >= len(full_text):
+            break
+
+    return chunks
+
+
+def process_one_pdf(pdf_path: str, filename: str, extract_images: bool) -> tuple:
+    """Extract and chunk one PDF in a worker process. Returns (page count, chunks, images)."""
+    pages, images = extract_pdf_content(pdf_path, extract_images)
+    chunks = chunk_text(pages, filename)
+    return len(pages), chunks, images
@@ -18,64 +18,14 @@ load_dotenv()
 
 # Configuration
 CHROMA_PATH = os.path.expanduser("~/Desktop/StudyAssistant/chroma_db")
+CHROMA_HOST = os.environ.get("CHROMA_HOST")  # set to query a `chroma run` server instead of opening CHROMA_PATH
+CHROMA_PORT = int(os.environ.get("CHROMA_PORT", "8000"))
 COLLECTION_NAME = "study_materials"
 TOP_K = 10  # Number of chunks to retrieve
 
 
-def get_relevant_chunks(query: str, top_k: int = TOP_K) -> list:
-    """Retrieve relevant chunks from ChromaDB."""
-    # Initialize embedding model
-    embedder = SentenceTransformer('all-mpnet-base-v2')
-
-    # Initialize ChromaDB
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-
-    try:
-        collection = client.get_collection(name=COLLECTION_NAME)
-    except:
-        print("Error: No documents found. Please run ingest.py first.")
-        sys.exit(1)
-
-    if collection.count() == 0:
-        print("Error: Database is empty. Please run ingest.py first.")
-        sys.exit(1)
-
-    # Generate query embedding
-    query_embedding = embedder.encode(query).tolist()
-
-    # Search
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"]
-    )
-
-    chunks = []
-    for i in range(len(results['ids'][0])):
-        chunks.append({
-            "text": results['documents'][0][i],
-            "filename": results['metadatas'][0][i]['filename'],
-            "pages": results['metadatas'][0][i]['pages'],
-            "distance": results['distances'][0][i]
-        })
-
-    return chunks
-
-
-def query_claude(question: str, chunks: list) -> str:
-    """Send question and context to Claude, get answer with citations."""
-
-    # Build context from chunks
-    context_parts = []
-    for i, chunk in enumerate(chunks, 1):
-        context_parts.append(
-            f"[Source {i}: {chunk['filename']}, Page(s): {chunk['pages']}]\n{chunk['text']}"
-        )
-
-    context = "\n\n---\n\n".join(context_parts)
-
-    # System prompt enforcing citation requirements (IEEE/Vancouver style)
-    system_prompt = """You are a study assistant that answers questions ONLY based on the provided context from course materials.
+# System prompt enforcing citation requirements (IEEE/Vancouver style)
+SYSTEM_PROMPT = """You are a study assistant that answers questions ONLY based on the provided context from course materials.
 
 CRITICAL RULES:
 1. ONLY use information from the provided context to answer questions
@@ -94,7 +44,7 @@ FORMAT YOUR RESPONSE:
   [2] Filename, Page(s): Y
   etc."""
 
-    user_message = f"""Based on the following excerpts from my course materials, please answer my question.
+USER_MESSAGE_TEMPLATE = """Based on the following excerpts from my course materials, please answer my question.
 
 CONTEXT FROM COURSE MATERIALS:
 {context}
@@ -103,19 +53,105 @@ MY QUESTION: {question}
 
 Remember: Only use information from the context above. Use numbered citations [1], [2], etc. inline and list full references at the end."""
 
+
+# Loaded on first use, then reused for every question in interactive mode
+_embedder = None
+_collection = None
+_claude = None
+
+
+def _get_embedder() -> SentenceTransformer:
+    """Return the shared embedding model, loading it on first use."""
+    global _embedder
+    if _embedder is None:
+        _embedder = SentenceTransformer('all-mpnet-base-v2')
+    return _embedder
+
+
+def _get_collection():
+    """Return the shared ChromaDB collection, exiting if it is missing or empty."""
+    global _collection
+    if _collection is None:
+        try:
+            if CHROMA_HOST:
+                client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+            else:
+                client = chromadb.PersistentClient(path=CHROMA_PATH)
+            collection = client.get_collection(name=COLLECTION_NAME)
+        except:
+            print("Error: No documents found. Please run ingest.py first.")
+            sys.exit(1)
+
+        if collection.count() == 0:
+            print("Error: Database is empty. Please run ingest.py first.")
+            sys.exit(1)
+
+        _collection = collection
+    return _collection
+
+
+def _get_claude() -> anthropic.Anthropic:
+    """Return the shared Anthropic client (keeps its HTTP connection alive between questions)."""
+    global _claude
+    if _claude is None:
+        _claude = anthropic.Anthropic()
+    return _claude
+
+
+def get_relevant_chunks(query: str, top_k: int = TOP_K) -> list:
+    """Retrieve relevant chunks from ChromaDB."""
+    embedder = _get_embedder()
+    collection = _get_collection()
+
+    # Generate query embedding
+    query_embedding = embedder.encode(query, convert_to_numpy=True, normalize_embeddings=True)
+
+    # Search
+    results = collection.query(
+        query_embeddings=query_embedding.reshape(1, -1),
+        n_results=top_k,
+        include=["documents", "metadatas"]
+    )
+
+    docs, metas = results['documents'][0], results['metadatas'][0]
+    return [
+        {"text": doc, "filename": meta['filename'], "pages": meta['pages']}
+        for doc, meta in zip(docs, metas)
+    ]
+
+
+def query_claude(question: str, chunks: list):
+    """Send question and context to Claude and stream the answer with citations."""
+
+    # Build context from chunks
+    context = "\n\n---\n\n".join(
+        f"[Source {i}: {chunk['filename']}, Page(s): {chunk['pages']}]\n{chunk['text']}"
+        for i, chunk in enumerate(chunks, 1)
+    )
+
+    user_message = USER_MESSAGE_TEMPLATE.format(context=context, question=question)
+
     # Call Claude API
-    client = anthropic.Anthropic()
+    client = _get_claude()
 
-    response = client.messages.create(
+    with client.messages.stream(
         model="claude-sonnet-4-20250514",
         max_tokens=2048,
-        system=system_prompt,
+        system=SYSTEM_PROMPT,
         messages=[
             {"role": "user", "content": user_message}
         ]
-    )
+    ) as stream:
+        yield from stream.text_stream
+
 
-    return response.content[0].text
+def print_answer(question: str, chunks: list):
+    """Print Claude's answer as it streams in."""
+    print("-" * 60)
+    for text in query_claude(question, chunks):
+        print(text, end="", flush=True)
+    print()
+    print("-" * 60)
 
 
 def main():
@@ -163,6 +199,8 @@ def main():
 
     # Load models once for interactive mode
     print("\nLoading models...")
+    _get_embedder()
+    _get_collection()
 
     if args.interactive:
         print("\nInteractive mode. Type 'quit' or 'exit' to stop.\n")
@@ -192,10 +230,7 @@ def main():
                     print(f"      {preview}...")
 
             print("\n🤖 Generating answer...\n")
-            answer = query_claude(question, chunks)
-            print("-" * 60)
-            print(answer)
-            print("-" * 60)
+            print_answer(question, chunks)
 
     else:
         if not args.question:
@@ -214,10 +249,7 @@ def main():
                 print(f"      {preview}...")
 
         print("\n🤖 Generating answer...\n")
-        answer = query_claude(args.question, chunks)
-        print("-" * 60)
-        print(answer)
-        print("-" * 60)
+        print_answer(args.question, chunks)
 
 
 if __name__ == "__main__":